@@ -9,6 +9,7 @@ from logging import getLogger
 
 from ckanext.contact.auth import send_contact
 from ckanext.contact import routes
+from ckanext.contact.routes import _helpers
 
 from ckan.plugins import SingletonPlugin, implements, interfaces, toolkit
 
@@ -21,6 +22,7 @@ class ContactPlugin(SingletonPlugin):
     implements(interfaces.IConfigurer)
     implements(interfaces.IAuthFunctions)
     implements(interfaces.ITemplateHelpers, inherit=True)
+    implements(interfaces.IPackageController, inherit=True)
 
     ## IConfigurer
     def update_config(self, config):
@@ -47,3 +49,15 @@ class ContactPlugin(SingletonPlugin):
             'get_recaptcha_v3_key':
                 functools.partial(toolkit.config.get, 'ckanext.contact.recaptcha_v3_key', None)
         }
+
+    ## IPackageController
+    def after_create(self, context, pkg_dict):
+        # the package's contact details may have changed, this only clears the current worker's
+        # cache, the others expire their entries after _helpers._PKG_CONTACT_TTL seconds
+        _helpers._pkg_contact.cache_clear()
+
+    def after_update(self, context, pkg_dict):
+        _helpers._pkg_contact.cache_clear()
+
+    def after_delete(self, context, pkg_dict):
+        _helpers._pkg_contact.cache_clear()
@@ -4,23 +4,240 @@
 # This file is part of ckanext-contact
 # Created by the Natural History Museum in London, UK
 import logging
-import socket
+import time
 from ckan import logic
 from ckan.common import asbool
-from ckan.lib import mailer
+from ckan.lib.redis import connect_to_redis
 from ckan.lib.navl.dictization_functions import unflatten
 from ckan.plugins import PluginImplementations, toolkit
 from ckanext.contact import recaptcha
 from ckanext.contact.interfaces import IContact
 from datetime import datetime, timezone
+from functools import lru_cache
+from operator import itemgetter
 
 from flask import render_template
+from redis import RedisError
 
-from jinja2 import escape
+from markupsafe import escape
 
 
 log = logging.getLogger(__name__)
 
+# the functions used to parse the request params, bound here to avoid looking them up per request
+_clean_dict = logic.clean_dict
+_tuplize_dict = logic.tuplize_dict
+_parse_params = logic.parse_params
+_unflatten = unflatten
+
+# the form variants we have email templates for, anything else falls back to the default
+FORM_VARIANTS = ('contact', 'suggest_dataset')
+DEFAULT_FORM_VARIANT = 'contact'
+
+# the longest time, in seconds, a dataset's contact details are cached for in each worker
+_PKG_CONTACT_TTL = 300
+
+# how long, in seconds, the recaptcha free submission count is kept for each IP address
+_RECAPTCHA_FREE_PERIOD = 3600
+
+# the fields that must be filled in and the error used when they aren't
+_FIELDS = ('email', 'name', 'content')
+_MISSING = ('Missing Value',)
+_get_fields = itemgetter(*_FIELDS)
+
+# default values for optional fields, used when the field is missing or empty
+_DEFAULTS_COMMON = (
+    ('contact-dest', 'data-hub-support'),
+    ('pkg-id', ''),
+)
+_DEFAULTS_SUGGEST = (
+    ('resource', 'N/A'),
+    ('maintainer', 'N/A'),
+    ('url', 'N/A'),
+)
+# the suggest dataset fields are always blanked for regular contact messages, overwriting anything
+# posted, so the templates don't break and only suggest_dataset emails include them
+_BLANK_CONTACT_FIELDS = tuple(field for field, _default in _DEFAULTS_SUGGEST)
+
+# plain text email bodies for each form variant, filled in with the data_dict
+_CONTACT_BODY_TMPL = (
+    '{content}\n'
+    '\n'
+    'Sent by:\n'
+    '  Name: {name}\n'
+    '  Email: {email}'
+)
+_SUGGEST_BODY_TMPL = (
+    _CONTACT_BODY_TMPL + '\n'
+    '  Title of Resource: {resource}\n'
+    '  Who owns or maintains this resource? {maintainer}\n'
+    '  Link: {url}'
+)
+
+
+@lru_cache(maxsize=32)
+def _cfg(key, default=None):
+    '''
+    Returns the value of the given config option, caching it for the lifetime of the worker as the
+    extension's options don't change once CKAN has loaded. Options that can be edited at runtime
+    (like ckan.site_title) should be read from the config directly instead.
+
+    :param key: the config option name
+    :param default: the value to return if the option isn't set
+    :return: the config value
+    '''
+    return toolkit.config.get(key, default)
+
+
+@lru_cache(maxsize=1)
+def _site_url():
+    '''
+    Returns the external URL of the site's home page in the default locale. url_for would
+    otherwise add the current request's language prefix (e.g. /fr/), so the default locale is
+    requested explicitly to make the URL the same for every request and worth caching per worker.
+
+    :return: the home page URL
+    '''
+    return toolkit.url_for('home.index', _external=True, locale='default')
+
+
+@lru_cache(maxsize=512)
+def _pkg_contact(pkg_id, ttl_bucket):
+    '''
+    Returns the contact details of the given package, caching them as the same dataset is often
+    contacted many times. The ttl_bucket should change every _PKG_CONTACT_TTL seconds so that
+    entries expire in every worker, the plugin also clears the cache whenever a package is created,
+    updated or deleted. If the package doesn't exist ObjectNotFound is raised, which isn't cached.
+
+    :param pkg_id: the package's id or name
+    :param ttl_bucket: the current TTL period, used as part of the cache key
+    :return: a 3-tuple of the data contact email (or an empty string if it doesn't have one),
+             whether the package is private and the package's state
+    '''
+    # ignore auth as the result is shared between users, access to private and non-active
+    # packages is checked separately for each request
+    pkg = toolkit.get_action('package_show')({'ignore_auth': True}, {'id': pkg_id})
+    return pkg.get('data_contact_email') or '', bool(pkg.get('private')), pkg.get('state')
+
+
+def _pkg_contact_email(pkg_id):
+    '''
+    Returns the data contact email of the given package. The email of a private, draft or deleted
+    package is only returned if the current user can see the package.
+
+    :param pkg_id: the package's id or name
+    :return: the email address, or an empty string if the package doesn't exist, has no email or
+             the user can't access it
+    '''
+    try:
+        email, private, state = _pkg_contact(pkg_id, int(time.time() // _PKG_CONTACT_TTL))
+    except toolkit.ObjectNotFound:
+        return ''
+    # package_show only lets everyone see public, active packages so check access for the rest
+    if email and (private or state != 'active'):
+        try:
+            toolkit.check_access('package_show', {'user': toolkit.c.user}, {'id': pkg_id})
+        except toolkit.NotAuthorized:
+            return ''
+    return email
+
+
+@lru_cache(maxsize=1)
+def _contact_plugins():
+    '''
+    Returns the plugins implementing IContact. The plugins are loaded when CKAN starts so the list
+    is only resolved once per worker; call _contact_plugins.cache_clear() if they're reloaded.
+
+    :return: a tuple of plugins
+    '''
+    return tuple(PluginImplementations(IContact))
+
+
+def _send_email(mail_dict):
+    '''
+    Sends the email described by the mail_dict. If ckanext.contact.send_in_background is enabled
+    the email is sent by a background job, falling back to sending it straight away if the job
+    can't be queued.
+
+    :param mail_dict: the keyword arguments for mailer.mail_recipient
+    :return: True if the email was sent or queued, False if sending it failed
+    '''
+    # imported here as the mailer pulls in smtplib, ssl and the email package, none of which are
+    # needed until an email is actually sent
+    import socket
+    from ckan.lib import mailer
+
+    if asbool(_cfg('ckanext.contact.send_in_background', False)):
+        try:
+            toolkit.enqueue_job(mailer.mail_recipient, kwargs=mail_dict, title='contact-email')
+            return True
+        except Exception as e:
+            log.warning(f'Failed to queue contact email, sending it now instead: {e}')
+
+    try:
+        mailer.mail_recipient(**mail_dict)
+    except (mailer.MailerException, socket.error):
+        return False
+    return True
+
+
+def _form_variant(data_dict):
+    '''
+    Returns the form variant to use for the given request params. Only the FORM_VARIANTS are
+    allowed so that arbitrary values can't be used to look up (and fill the template cache with)
+    other templates, anything else falls back to the DEFAULT_FORM_VARIANT.
+
+    :param data_dict: the request params as a dict
+    :return: the form variant
+    '''
+    form_variant = data_dict.get('form_variant')
+    return form_variant if form_variant in FORM_VARIANTS else DEFAULT_FORM_VARIANT
+
+
+def _recaptcha_enabled():
+    '''
+    Checks whether recaptcha has been setup, i.e. both the key and the secret have been provided.
+
+    :return: True if recaptcha is enabled, False if not
+    '''
+    return bool(_cfg('ckanext.contact.recaptcha_v3_key') and
+                _cfg('ckanext.contact.recaptcha_v3_secret'))
+
+
+def _allow_skip_recaptcha():
+    '''
+    Counts the current request's submission against its IP address and checks whether it's within
+    the number of submissions per hour that are allowed without a recaptcha check, as set by
+    ckanext.contact.recaptcha_free_submissions. This is disabled by default and if the count can't
+    be checked the recaptcha is always verified.
+
+    :return: True if the recaptcha check can be skipped, False if not
+    '''
+    try:
+        limit = toolkit.asint(_cfg('ckanext.contact.recaptcha_free_submissions', 0))
+    except ValueError:
+        log.warning('Invalid ckanext.contact.recaptcha_free_submissions value, it should be an '
+                    'integer, always checking the recaptcha')
+        return False
+    if limit <= 0:
+        return False
+
+    client_ip_address = toolkit.request.environ.get('REMOTE_ADDR', None)
+    if not client_ip_address:
+        return False
+
+    key = f'ckanext-contact:recaptcha-free:{client_ip_address}'
+    try:
+        redis_conn = connect_to_redis()
+        count = redis_conn.incr(key)
+        if count == 1:
+            redis_conn.expire(key, _RECAPTCHA_FREE_PERIOD)
+    except RedisError as e:
+        log.warning(f'Failed to count recaptcha free submissions: {e}')
+        return False
+
+    return count <= limit
+
 
 def validate(data_dict):
     '''
@@ -35,17 +252,21 @@ def validate(data_dict):
     recaptcha_error = None
 
     # check the three fields we know about
-    for field in ('email', 'name', 'content'):
-        value = data_dict.get(field, None)
-        if value is None or value == '':
-            errors[field] = ['Missing Value']
+    try:
+        values = _get_fields(data_dict)
+    except KeyError:
+        # at least one of the fields isn't present at all
+        values = tuple(data_dict.get(field) for field in _FIELDS)
+    for field, value in zip(_FIELDS, values):
+        if not value:
+            errors[field] = _MISSING
             error_summary[field] = 'Missing value'
 
-    # only check the recaptcha if there are no errors
-    if not errors:
+    # only check the recaptcha if there are no errors and it has been setup
+    if not errors and _recaptcha_enabled() and not _allow_skip_recaptcha():
+        expected_action = _cfg('ckanext.contact.recaptcha_v3_action')
         try:
-            expected_action = toolkit.config.get('ckanext.contact.recaptcha_v3_action')
-            # check the recaptcha value, this only does anything if recaptcha is setup
+            # check the recaptcha value
             recaptcha.check_recaptcha(data_dict.get('g-recaptcha-response', None), expected_action)
         except recaptcha.RecaptchaError as e:
             log.info(f'Recaptcha failed due to "{e}" : {expected_action}')
@@ -54,21 +275,67 @@ def validate(data_dict):
     return errors, error_summary, recaptcha_error
 
 
-def build_subject(form_variant='contact', subject_default='Contact/Question from visitor', timestamp_default=False):
+def _now_str():
+    '''
+    Returns the current UTC time formatted for use in the email subject and body.
+
+    :return: the formatted timestamp
+    '''
+    return datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S %Z')
+
+
+def build_subject(form_variant='contact', subject_default='Contact/Question from visitor',
+                  timestamp_default=False, *, now_str=None):
     '''
     Creates the subject line for the contact email using the config or the defaults.
 
     :param subject_default: the default str to use if ckanext.contact.subject isn't specified
     :param timestamp_default: the default bool to use if add_timestamp_to_subject isn't specified
+    :param now_str: the formatted timestamp to add to the subject, if not passed the current time
+                    is used
     :return: the subject line
     '''
-    subject = toolkit.config.get(f'ckanext.{form_variant}.subject', toolkit._(subject_default))
-    if asbool(toolkit.config.get('ckanext.contact.add_timestamp_to_subject', timestamp_default)):
-        timestamp = datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S %Z')
-        subject = f'{subject} [{timestamp}]'
+    subject = _cfg(f'ckanext.{form_variant}.subject')
+    if subject is None:
+        # translate the default here rather than caching it as it depends on the request's locale
+        subject = toolkit._(subject_default)
+    if asbool(_cfg('ckanext.contact.add_timestamp_to_subject', timestamp_default)):
+        subject = f'{subject} [{now_str or _now_str()}]'
     return subject
 
 
+def _build_contact_body(data_dict):
+    '''
+    Blanks the suggest dataset fields for a regular contact message and creates the plain text
+    email body.
+
+    :param data_dict: the request params as a dict, updated in place
+    :return: the email body
+    '''
+    for field in _BLANK_CONTACT_FIELDS:
+        data_dict[field] = ''
+    return _CONTACT_BODY_TMPL.format_map(data_dict)
+
+
+def _build_suggest_body(data_dict):
+    '''
+    Fills in the defaults for a dataset suggestion and creates the plain text email body.
+
+    :param data_dict: the request params as a dict, updated in place with the defaults
+    :return: the email body
+    '''
+    for field, default in _DEFAULTS_SUGGEST:
+        data_dict[field] = data_dict.get(field) or default
+    return _SUGGEST_BODY_TMPL.format_map(data_dict)
+
+
+# the plain text body builder for each of the FORM_VARIANTS
+_BODY_BUILDERS = {
+    'contact': _build_contact_body,
+    'suggest_dataset': _build_suggest_body,
+}
+
+
 def submit():
     '''
     Take the data in the request params and send an email using them. If the data is invalid or
@@ -80,62 +347,47 @@ def submit():
     email_success = True
 
     # pull out the data from the request
-    data_dict = logic.clean_dict(
-        unflatten(logic.tuplize_dict(logic.parse_params(toolkit.request.values)))
-    )
+    data_dict = _clean_dict(_unflatten(_tuplize_dict(_parse_params(toolkit.request.values))))
 
     # validate the request params
     errors, error_summary, recaptcha_error = validate(data_dict)
 
     # if there are not errors and no recaptcha error, attempt to send the email
-    if len(errors) == 0 and recaptcha_error is None:
-
-        # set default form variant if not set
-        if( data_dict['form_variant'] == '' ):
-            data_dict['form_variant'] = 'contact'
-
-        body_parts = [ f'{data_dict["content"]}\n' ];
-
-        body_parts.append( 'Sent by:' )
-        body_parts.append( f'  Name: {data_dict["name"]}' )
-        body_parts.append( f'  Email: {data_dict["email"]}' )
-
-        if( data_dict["form_variant"] == 'suggest_dataset' ):
-            # add 'suggest dataset' fields to email body
-            if( data_dict["resource"] and data_dict["resource"] != '' ):
-                body_parts.append( f'  Title of Resource: {data_dict["resource"]}' )
-            if( data_dict["maintainer"] and data_dict["maintainer"] != '' ):
-                body_parts.append( f'  Who owns or maintains this resource? {data_dict["maintainer"]}' )
-            if( data_dict["url"] and data_dict["url"] != '' ):
-                body_parts.append( f'  Link: {data_dict["url"]}' )
-        else:
-            # set 'suggest data' fields to empty so render_template won't break for regular contact message
-            data_dict['resource'] = '';
-            data_dict['maintainer'] = '';
-            data_dict['url'] = '';
+    if not errors and recaptcha_error is None:
+
+        data_dict['form_variant'] = _form_variant(data_dict)
+
+        for field, default in _DEFAULTS_COMMON:
+            data_dict[field] = data_dict.get(field) or default
+
+        body = _BODY_BUILDERS[data_dict['form_variant']](data_dict)
+
+        # build the subject and timestamp once so that the email header and html body match
+        now_str = _now_str()
+        subject = build_subject(data_dict['form_variant'], now_str=now_str)
+
+        # dict of context values for the email template renderer
+        extra_vars = {
+            'name': data_dict['name'],
+            'email': data_dict['email'],
+            'resource': data_dict['resource'],
+            'maintainer': data_dict['maintainer'],
+            'url': data_dict['url'],
+            # pre-escape message so that we can add </br> tags safely in the Jinja2 template
+            'message': escape(data_dict['content']),
+            'timestamp': now_str,
+            'site_title': toolkit.config.get('ckan.site_title'),
+            'site_url': _site_url(),
+            'subject': subject,
+        }
 
         mail_dict = {
-            'recipient_email': toolkit.config.get('ckanext.contact.mail_to',
-                                                  toolkit.config.get('email_to')),
-            'recipient_name': toolkit.config.get('ckanext.contact.recipient_name',
-                                                 toolkit.config.get('ckan.site_title')),
-            'subject': build_subject( data_dict["form_variant"] ),
-            'body': '\n'.join(body_parts),
-
-            'body_html': render_template(
-                f'emails/{data_dict["form_variant"]}.html',
-                name = data_dict['name'],
-                email = data_dict['email'],
-                resource = data_dict['resource'],
-                maintainer = data_dict['maintainer'],
-                url = data_dict['url'],
-                # pre-escape message so that we can add </br> tags safely in the Jinja2 template
-                message = escape( data_dict['content'] ),
-                timestamp = datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S %Z'),
-                site_title = toolkit.config.get('ckan.site_title'), 
-                site_url = toolkit.url_for( 'home.index', _external=True ),
-                subject = build_subject( data_dict["form_variant"] )
-            ),
+            'recipient_email': _cfg('ckanext.contact.mail_to') or _cfg('email_to'),
+            'recipient_name': _cfg('ckanext.contact.recipient_name') or
+                              toolkit.config.get('ckan.site_title'),
+            'subject': subject,
+            'body': body,
+            'body_html': render_template(f'emails/{data_dict["form_variant"]}.html', **extra_vars),
 
             # set reply-to to send to person submitting the form
             "headers": {
@@ -144,27 +396,24 @@ def submit():
         }
 
 
-        if( data_dict["contact-dest"] != "data-hub-support" and "pkg-id" in data_dict and data_dict["pkg-id"] != '' ):
-            pkg = toolkit.get_action('package_show')(None, {'id': data_dict["pkg-id"] } )
-            if( pkg["data_contact_email"] ): 
+        if data_dict['contact-dest'] != 'data-hub-support' and data_dict['pkg-id']:
+            pkg_email = _pkg_contact_email(data_dict['pkg-id'])
+            if pkg_email:
                 # 'cc' needs to be in the mail header, and passed in as a parameter to mail_recipient both due to the way smtlib.sendmail works
                 mail_dict["headers"]["cc"] =  mail_dict["recipient_email"] 
                 mail_dict["cc"] =  [mail_dict["recipient_email"]]
                 
-                mail_dict["recipient_email"] = pkg["data_contact_email"]
+                mail_dict["recipient_email"] = pkg_email
 
 
         # allow other plugins to modify the mail_dict
-        for plugin in PluginImplementations(IContact):
+        for plugin in _contact_plugins():
             plugin.mail_alter(mail_dict, data_dict)
 
-        try:
-            mailer.mail_recipient(**mail_dict)
-        except (mailer.MailerException, socket.error):
-            email_success = False
+        email_success = _send_email(mail_dict)
 
     return {
-        'success': recaptcha_error is None and len(errors) == 0 and email_success,
+        'success': recaptcha_error is None and not errors and email_success,
         'data': data_dict,
         'errors': errors,
         'error_summary': error_summary,
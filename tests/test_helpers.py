@@ -1,8 +1,29 @@
 import pytest
+import socket
 from datetime import datetime, timezone
 
-from ckanext.contact.routes._helpers import build_subject
+from ckan.lib import mailer
+from ckan.plugins import toolkit
+from ckanext.contact.routes._helpers import (_BODY_BUILDERS, _cfg, _contact_plugins,
+                                              _form_variant, _pkg_contact, _pkg_contact_email,
+                                              _allow_skip_recaptcha, _send_email, build_subject,
+                                              submit, validate)
 from freezegun import freeze_time
+from mock import MagicMock, patch
+from redis import RedisError
+from werkzeug.datastructures import MultiDict
+
+
+@pytest.fixture(autouse=True)
+def clear_caches():
+    # the ckan_config marker changes the config (and so the loaded plugins) between tests so make
+    # sure we don't see stale values
+    caches = (_cfg, _contact_plugins, _pkg_contact)
+    for cache in caches:
+        cache.cache_clear()
+    yield
+    for cache in caches:
+        cache.cache_clear()
 
 
 class TestBuildSubject:
@@ -56,3 +77,257 @@ class TestBuildSubject:
     def test_config_with_timestamp(self):
         subject = build_subject()
         assert subject == 'TEST SUBJECT'
+
+    def test_pass_now_str(self):
+        subject = build_subject(timestamp_default=True, now_str='TEST TIMESTAMP')
+        assert subject == 'Contact/Question from visitor [TEST TIMESTAMP]'
+
+
+class TestValidate:
+
+    def test_missing_fields(self):
+        errors, error_summary, recaptcha_error = validate({'name': 'Test', 'email': ''})
+        assert set(errors) == {'email', 'content'}
+        assert set(error_summary) == {'email', 'content'}
+        assert recaptcha_error is None
+
+    def test_recaptcha_not_configured_is_skipped(self):
+        data_dict = {'name': 'Test', 'email': 'test@example.com', 'content': 'Hello'}
+        with patch('ckanext.contact.recaptcha.check_recaptcha') as check_recaptcha:
+            assert validate(data_dict) == ({}, {}, None)
+        check_recaptcha.assert_not_called()
+
+
+class TestBuildBody:
+
+    def test_contact(self):
+        data_dict = {'name': 'Test', 'email': 'test@example.com', 'content': 'Hello',
+                     'resource': 'posted', 'maintainer': 'posted', 'url': 'posted'}
+        body = _BODY_BUILDERS['contact'](data_dict)
+        assert body == 'Hello\n\nSent by:\n  Name: Test\n  Email: test@example.com'
+        # posted suggest dataset fields are overwritten, not just defaulted
+        assert data_dict['resource'] == data_dict['maintainer'] == data_dict['url'] == ''
+
+    def test_suggest_dataset_defaults(self):
+        data_dict = {'name': 'Test', 'email': 'test@example.com', 'content': 'Hello',
+                     'url': 'https://example.com'}
+        body = _BODY_BUILDERS['suggest_dataset'](data_dict)
+        assert body.endswith('  Title of Resource: N/A\n'
+                             '  Who owns or maintains this resource? N/A\n'
+                             '  Link: https://example.com')
+
+
+class TestFormVariant:
+
+    @pytest.mark.parametrize('form_variant', ['contact', 'suggest_dataset'])
+    def test_known_variant(self, form_variant):
+        assert _form_variant({'form_variant': form_variant}) == form_variant
+
+    @pytest.mark.parametrize('data_dict', [
+        {},
+        {'form_variant': ''},
+        {'form_variant': 'custom_variant'},
+        {'form_variant': '../contact/form'},
+    ])
+    def test_unknown_or_empty_variant_falls_back_to_contact(self, data_dict):
+        assert _form_variant(data_dict) == 'contact'
+
+
+class TestPkgContactEmail:
+
+    def test_cached(self):
+        package_show = MagicMock(return_value={'data_contact_email': 'owner@example.com',
+                                               'state': 'active'})
+        with patch.object(toolkit, 'get_action', return_value=package_show):
+            assert _pkg_contact_email('pkg') == 'owner@example.com'
+            assert _pkg_contact_email('pkg') == 'owner@example.com'
+        package_show.assert_called_once_with({'ignore_auth': True}, {'id': 'pkg'})
+
+    def test_expires(self):
+        package_show = MagicMock(return_value={'data_contact_email': 'owner@example.com',
+                                               'state': 'active'})
+        with patch.object(toolkit, 'get_action', return_value=package_show):
+            with freeze_time('2021-01-01 00:00:00'):
+                _pkg_contact_email('pkg')
+            with freeze_time('2021-01-01 01:00:00'):
+                _pkg_contact_email('pkg')
+        assert package_show.call_count == 2
+
+    def test_not_found_is_not_cached(self):
+        package_show = MagicMock(side_effect=[toolkit.ObjectNotFound(),
+                                              {'data_contact_email': 'owner@example.com',
+                                               'state': 'active'}])
+        with patch.object(toolkit, 'get_action', return_value=package_show):
+            assert _pkg_contact_email('pkg') == ''
+            assert _pkg_contact_email('pkg') == 'owner@example.com'
+
+    def test_private_not_authorised(self):
+        package_show = MagicMock(return_value={'data_contact_email': 'owner@example.com',
+                                               'private': True, 'state': 'active'})
+        with patch.object(toolkit, 'get_action', return_value=package_show), \
+                patch.object(toolkit, 'c', MagicMock(user='')), \
+                patch.object(toolkit, 'check_access', side_effect=toolkit.NotAuthorized()):
+            assert _pkg_contact_email('pkg') == ''
+
+    def test_private_authorised(self):
+        package_show = MagicMock(return_value={'data_contact_email': 'owner@example.com',
+                                               'private': True, 'state': 'active'})
+        with patch.object(toolkit, 'get_action', return_value=package_show), \
+                patch.object(toolkit, 'c', MagicMock(user='member')), \
+                patch.object(toolkit, 'check_access', return_value=True) as check_access:
+            assert _pkg_contact_email('pkg') == 'owner@example.com'
+        check_access.assert_called_once_with('package_show', {'user': 'member'}, {'id': 'pkg'})
+
+    @pytest.mark.parametrize('state', ['deleted', 'draft'])
+    def test_not_active_not_authorised(self, state):
+        package_show = MagicMock(return_value={'data_contact_email': 'owner@example.com',
+                                               'private': False, 'state': state})
+        with patch.object(toolkit, 'get_action', return_value=package_show), \
+                patch.object(toolkit, 'c', MagicMock(user='')), \
+                patch.object(toolkit, 'check_access', side_effect=toolkit.NotAuthorized()):
+            assert _pkg_contact_email('pkg') == ''
+
+    @pytest.mark.parametrize('state', ['deleted', 'draft'])
+    def test_not_active_authorised(self, state):
+        package_show = MagicMock(return_value={'data_contact_email': 'owner@example.com',
+                                               'private': False, 'state': state})
+        with patch.object(toolkit, 'get_action', return_value=package_show), \
+                patch.object(toolkit, 'c', MagicMock(user='owner')), \
+                patch.object(toolkit, 'check_access', return_value=True) as check_access:
+            assert _pkg_contact_email('pkg') == 'owner@example.com'
+        check_access.assert_called_once_with('package_show', {'user': 'owner'}, {'id': 'pkg'})
+
+
+class TestSendEmail:
+
+    mail_dict = {'recipient_email': 'to@example.com', 'subject': 'Test'}
+
+    @pytest.mark.ckan_config('ckanext.contact.send_in_background', 'true')
+    def test_queued_in_background(self):
+        with patch.object(toolkit, 'enqueue_job') as enqueue_job, \
+                patch.object(mailer, 'mail_recipient') as mail_recipient:
+            assert _send_email(self.mail_dict)
+        enqueue_job.assert_called_once_with(mail_recipient, kwargs=self.mail_dict,
+                                            title='contact-email')
+        mail_recipient.assert_not_called()
+
+    @pytest.mark.ckan_config('ckanext.contact.send_in_background', 'true')
+    def test_queue_failure_sends_now(self):
+        with patch.object(toolkit, 'enqueue_job', side_effect=Exception('no redis')), \
+                patch.object(mailer, 'mail_recipient') as mail_recipient:
+            assert _send_email(self.mail_dict)
+        mail_recipient.assert_called_once_with(**self.mail_dict)
+
+    def test_sends_now_by_default(self):
+        with patch.object(toolkit, 'enqueue_job') as enqueue_job, \
+                patch.object(mailer, 'mail_recipient') as mail_recipient:
+            assert _send_email(self.mail_dict)
+        enqueue_job.assert_not_called()
+        mail_recipient.assert_called_once_with(**self.mail_dict)
+
+    @pytest.mark.parametrize('error', [mailer.MailerException('failed'), socket.error('failed')])
+    def test_send_failure(self, error):
+        with patch.object(mailer, 'mail_recipient', side_effect=error):
+            assert not _send_email(self.mail_dict)
+
+
+class TestAllowSkipRecaptcha:
+
+    @pytest.fixture
+    def redis_conn(self):
+        redis_conn = MagicMock()
+        with patch('ckanext.contact.routes._helpers.connect_to_redis', return_value=redis_conn), \
+                patch.object(toolkit, 'request', MagicMock(environ={'REMOTE_ADDR': '127.0.0.1'})):
+            yield redis_conn
+
+    def test_disabled_by_default(self, redis_conn):
+        assert not _allow_skip_recaptcha()
+        redis_conn.incr.assert_not_called()
+
+    @pytest.mark.ckan_config('ckanext.contact.recaptcha_free_submissions', '0')
+    def test_limit_zero_never_skips(self, redis_conn):
+        assert not _allow_skip_recaptcha()
+        redis_conn.incr.assert_not_called()
+
+    @pytest.mark.ckan_config('ckanext.contact.recaptcha_free_submissions', 'lots')
+    def test_invalid_limit_never_skips(self, redis_conn):
+        assert not _allow_skip_recaptcha()
+        redis_conn.incr.assert_not_called()
+
+    @pytest.mark.ckan_config('ckanext.contact.recaptcha_free_submissions', '2')
+    def test_limit_enforced(self, redis_conn):
+        redis_conn.incr.side_effect = [1, 2, 3]
+        assert _allow_skip_recaptcha()
+        assert _allow_skip_recaptcha()
+        assert not _allow_skip_recaptcha()
+        redis_conn.incr.assert_called_with('ckanext-contact:recaptcha-free:127.0.0.1')
+
+    @pytest.mark.ckan_config('ckanext.contact.recaptcha_free_submissions', '2')
+    def test_expiry_only_set_on_first_hit(self, redis_conn):
+        redis_conn.incr.side_effect = [1, 2]
+        _allow_skip_recaptcha()
+        _allow_skip_recaptcha()
+        redis_conn.expire.assert_called_once_with('ckanext-contact:recaptcha-free:127.0.0.1', 3600)
+
+    @pytest.mark.ckan_config('ckanext.contact.recaptcha_free_submissions', '2')
+    def test_redis_error_verifies(self, redis_conn):
+        redis_conn.incr.side_effect = RedisError('down')
+        assert not _allow_skip_recaptcha()
+
+    @pytest.mark.ckan_config('ckanext.contact.recaptcha_free_submissions', '2')
+    def test_missing_remote_addr_verifies(self, redis_conn):
+        with patch.object(toolkit, 'request', MagicMock(environ={})):
+            assert not _allow_skip_recaptcha()
+        redis_conn.incr.assert_not_called()
+
+
+@pytest.mark.ckan_config('ckanext.contact.mail_to', 'default@example.com')
+@pytest.mark.ckan_config('ckanext.contact.subject', 'TEST SUBJECT')
+class TestSubmit:
+
+    @pytest.fixture
+    def send_email(self):
+        with patch('ckanext.contact.routes._helpers.render_template', return_value='<p>html</p>'), \
+                patch('ckanext.contact.routes._helpers._site_url', return_value='http://ckan'), \
+                patch('ckanext.contact.routes._helpers._send_email',
+                      return_value=True) as send_email:
+            yield send_email
+
+    @staticmethod
+    def request(**params):
+        values = MultiDict({'name': 'Test', 'email': 'test@example.com', 'content': 'Hello',
+                            **params})
+        return patch.object(toolkit, 'request', MagicMock(values=values, environ={}))
+
+    def test_sent_to_dataset_contact(self, send_email):
+        package_show = MagicMock(return_value={'data_contact_email': 'owner@example.com',
+                                               'private': False, 'state': 'active'})
+        with self.request(**{'contact-dest': 'dataset', 'pkg-id': 'pkg'}), \
+                patch.object(toolkit, 'get_action', return_value=package_show):
+            result = submit()
+
+        assert result['success']
+        package_show.assert_called_once_with({'ignore_auth': True}, {'id': 'pkg'})
+        mail_dict = send_email.call_args[0][0]
+        assert mail_dict['recipient_email'] == 'owner@example.com'
+        assert mail_dict['headers']['cc'] == 'default@example.com'
+        assert mail_dict['cc'] == ['default@example.com']
+        assert mail_dict['headers']['Reply-to'] == 'test@example.com'
+
+    @pytest.mark.parametrize('params', [
+        {'pkg-id': 'pkg'},
+        {'contact-dest': 'data-hub-support', 'pkg-id': 'pkg'},
+        {'contact-dest': 'dataset'},
+        {'contact-dest': 'dataset', 'pkg-id': ''},
+    ])
+    def test_sent_to_default_recipient(self, send_email, params):
+        with self.request(**params), patch.object(toolkit, 'get_action') as get_action:
+            result = submit()
+
+        assert result['success']
+        get_action.assert_not_called()
+        assert result['data']['contact-dest'] == params.get('contact-dest', 'data-hub-support')
+        mail_dict = send_email.call_args[0][0]
+        assert mail_dict['recipient_email'] == 'default@example.com'
+        assert 'cc' not in mail_dict
+        assert 'cc' not in mail_dict['headers']